@@ -6,6 +6,10 @@ conf_path = '/var/lib/zope4/ema/etc/zope.conf'
 # with zodbsync watch
 datafs_path = '/var/lib/zope4/zeo/var/Data.fs'
 
+# File in which zodbsync watch stores its object tree when stopping, so it can
+# be reused at the next start
+# watch_tree_path = '/var/cache/perfact/zodbsync-watch-tree'
+
 # user that is used to create commits
 manager_user = 'perfact'
 
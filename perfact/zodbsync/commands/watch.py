@@ -10,15 +10,30 @@ import sys
 import shutil
 import pickle
 import subprocess
+import mmap
+import struct
+import errno
+import collections
+import queue
+import selectors
+import uuid
+import itertools
+import logging
 
 # For reading the Data.FS in order to obtain affected object IDs from
 # transaction IDs
 import ZODB.FileStorage
+from ZODB.FileStorage.format import DATA_HDR_LEN
 
 from ..subcommand import SubCommand
 from ..helpers import remove_redundant_paths, increment_txnid
 from ..zodbsync import mod_read
 
+# A data record header in the Data.FS consists of oid, tid, prev, tloc, vlen
+# and plen. We only need the oid and the length of the pickle data.
+DATA_HEADER = struct.Struct('>8s26xQ')
+assert DATA_HEADER.size == DATA_HDR_LEN
+
 
 class TreeOutdatedException(Exception):
     """Exception which is raised if the internal tree structure
@@ -46,17 +61,37 @@ class Watch(SubCommand):
         super(Watch, self).__init__(**kw)
         self.base_dir = self.sync.app_dir
         self.app = self.sync.app
-        # an event that is fired if we are to be terminated
-        self.exit = threading.Event()
-
-        try:
-            self.datafs_path = self.config["datafs_path"]
-        except AttributeError:
-            self.logger.exception("watch requires datafs_path in config")
-            raise
-
-        # mapping from object id to dict describing tree structure
-        self.object_tree = {}
+        # set if we are to be terminated
+        self.exiting = False
+
+        # Folders that are to be removed are moved into the trash folder and
+        # removed by a background thread, fed by a queue
+        self.trash_dir = self._find_trash_dir()
+        # Objects that were removed from their parent are moved here
+        self.orphans_dir = os.path.normpath(self.base_dir + '/../__orphans__')
+        self.trash_queue = queue.Queue()
+        self.trash_thread = None
+
+        # If the Data.FS is accessible, it is read directly to obtain the
+        # affected object IDs. Otherwise, the iterator provided by the storage
+        # is used, which also works with a remote ZEO.
+        self.datafs_path = self.config.get("datafs_path")
+
+        # If given, the object tree is stored there when stopping and reused
+        # at the next start
+        self.tree_path = self.config.get("watch_tree_path")
+
+        # The tree structure of the objects, given by a mapping from each
+        # object id to the id of its parent and a mapping from each object id
+        # to a dict that maps the object ids of its children to their ids.
+        # Orphaned objects that were removed from their parent have no parent
+        # and are found below the __orphans__ folder. Paths are derived from
+        # these when needed.
+        self.parent_of = {}
+        self.children_of = {}
+        self.root_oid = bytes(self.app._p_oid)
+        # paths computed from the above while processing a set of changes
+        self._path_cache = {}
 
         # Mapping of additional object ids to OIDs of recorded objects. This is
         # currently only used for `User Folder`s which contain a
@@ -85,106 +120,278 @@ class Watch(SubCommand):
             self.txnid_on_disk = self.last_visible_txn
             self.sync.txn_write(base64.b64encode(self.last_visible_txn))
 
-    def _init_tree(self, obj, parent_oid=None, path='/'):
-        ''' Insert obj and everything below into self.object_tree. '''
+    def _find_trash_dir(self):
+        '''
+        Return the folder to be used as trash. It is placed inside the git
+        directory of the repository, so whatever is left there while it is
+        being removed is never picked up by a commit, but it is usually still
+        on the same file system as the recorded objects.
+        '''
+        base_dir = self.config['base_dir']
+        try:
+            git_dir = self.gitcmd_output('rev-parse', '--git-dir').strip()
+        except (subprocess.CalledProcessError, OSError):
+            # Not a git repository, so there is nothing to hide it from
+            return os.path.join(base_dir, '__trash__')
+        return os.path.join(base_dir, git_dir, 'zodbsync-trash')
+
+    def _trash(self, path):
+        '''
+        Move the folder at the given path into the trash folder, from where it
+        is removed in the background. Moving is cheap as long as the trash
+        folder is on the same file system, so we need not wait for the
+        removal of large subtrees.
+        '''
+        os.makedirs(self.trash_dir, exist_ok=True)
+        target = os.path.join(self.trash_dir, uuid.uuid4().hex)
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            return
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            # The trash is on a different file system, remove it right away
+            shutil.rmtree(path)
+            return
+        if self.trash_thread is None:
+            self.trash_thread = threading.Thread(
+                target=self._empty_trash,
+                daemon=True,
+            )
+            self.trash_thread.start()
+        self.trash_queue.put(target)
+
+    def _empty_trash(self):
+        '''
+        Worker for the background thread, removing folders that were moved to
+        the trash until it receives None.
+        '''
+        while True:
+            path = self.trash_queue.get()
+            if path is None:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _stop_trash(self, timeout=10):
+        '''
+        Wait for the background thread to remove what is left in the trash.
+        '''
+        if self.trash_thread is None:
+            return
+        self.trash_queue.put(None)
+        self.trash_thread.join(timeout)
+        self.trash_thread = None
+
+    def _init_tree(self, obj):
+        ''' Insert obj and everything below into our tree structure. '''
         if not hasattr(obj, '_p_oid'):
             # objects that have no oid are ignored
             return None
+        parent_of = self.parent_of
+        children_of = self.children_of
+        add_additional_oids = self._add_additional_oids
+        intern = sys.intern
+
         # In some Python/Zope versions, _p_oid is a zodbpickle.binary, which is
         # not pickleable. We always convert it into bytes.
-        oid = bytes(obj._p_oid)
+        root_oid = bytes(obj._p_oid)
+        parent_of[root_oid] = None
 
-        children = {}  # map oid -> id
-
-        now = time.time()
+        # Walk the tree depth-first using an explicit stack, which is not
+        # limited by the recursion depth. Each entry holds an object and its
+        # oid, which is already linked to its parent.
+        stack = [(obj, root_oid)]
         if self.last_report is None:
-            self.last_report = now
-        if now - self.last_report > 2:
-            self.logger.info("Building tree: " + path)
-            self.last_report = now
-
-        self.object_tree[oid] = {
-            'oid': oid,
-            'parent': parent_oid,
-            'children': children,
-            'path': path,
-        }
+            self.last_report = time.time()
+        count = 0
+        while stack:
+            obj, oid = stack.pop()
+
+            # Only look at the clock every so often
+            count += 1
+            if count % 1000 == 0:
+                now = time.time()
+                if now - self.last_report > 2:
+                    self.logger.info("Building tree: " + self._path(oid))
+                    self.last_report = now
+
+            add_additional_oids(obj, oid)
+
+            children = {}  # map oid -> id
+            children_of[oid] = children
+            pending = []
+            for child_id, child_obj in sorted(obj.objectItems()):
+                if not hasattr(child_obj, '_p_oid'):
+                    continue
+                # Many ids are repeated throughout the tree, so interning
+                # them saves memory and speeds up comparisons
+                child_id = intern(child_id)
+                child_oid = bytes(child_obj._p_oid)
+                children[child_oid] = child_id
+                parent_of[child_oid] = oid
+                pending.append((child_obj, child_oid))
+            # Push in reverse so children are visited in sorted order
+            stack.extend(reversed(pending))
+        return root_oid
 
+    def _add_additional_oids(self, obj, oid):
+        '''
+        Map the oids of objects that are not part of our tree, but whose
+        changes show up in the recorded data of obj, to the oid of obj.
+        '''
         # If it turns out there are other objects needing such a hack, this
         # should probably be moved to object_types
         if obj.meta_type == 'User Folder':
-            self.additional_oids[bytes(obj.data._p_oid)] = oid
+            additional_oids = self.additional_oids
+            additional_oids[bytes(obj.data._p_oid)] = oid
             for user in obj.getUsers():
-                self.additional_oids[bytes(user._p_oid)] = oid
-
-        for child_id, child_obj in sorted(obj.objectItems()):
-            child_oid = self._init_tree(
-                obj=child_obj,
-                parent_oid=oid,
-                path=path+child_id+'/'
-            )
-            if child_oid:
-                children[child_oid] = child_id
-        return oid
+                additional_oids[bytes(user._p_oid)] = oid
 
     def _read_changed_oids(self, txn_start, txn_stop):
         """
-        Return a set of object IDS that are affected by the transactions with
-        IDs between start and stop (incl.)
+        Collect the set of object IDS that are affected by the transactions
+        with IDs between start and stop (incl.) and are part of our object
+        tree. Any other objects are either not reachable or new. New objects
+        are found when updating the children of their parent, which is
+        changed as well, so we need not keep track of them here. For large
+        transactions, most affected objects are internal (like BTree buckets),
+        so this keeps the set small.
+        """
+        self.changed_oids = set()
+        if txn_start > txn_stop:
+            return
+        if self.datafs_path:
+            self._read_changed_oids_datafs(txn_start, txn_stop)
+        else:
+            self._read_changed_oids_storage(txn_start, txn_stop)
+
+    def _read_changed_oids_storage(self, txn_start, txn_stop):
+        """
+        Collect changed object IDs using the iterator of the storage. This
+        transfers the data records themselves, so it is slower than reading
+        the Data.FS directly, but it works with any storage supporting
+        iteration, including a ClientStorage connected to a remote ZEO.
+        """
+        storage = self.app._p_jar.db().storage
+        get_oid = self.additional_oids.get
+        known = self.parent_of
+        add_oid = self.changed_oids.add
+        for txn in storage.iterator(txn_start, txn_stop):
+            for record in txn:
+                oid = bytes(record.oid)
+                oid = get_oid(oid, oid)
+                if oid in known:
+                    add_oid(oid)
+
+    def _read_changed_oids_datafs(self, txn_start, txn_stop):
+        """
+        Collect changed object IDs by reading the data headers from the
+        Data.FS.
         """
         # FileIterator opens the Data.FS read-only and provides the following
         # fields and methods:
         # * _file: The file object for the opened Data.FS
-        # * _read_data_header(pos): reads a data header at some position in the
-        #   file
         # * _ltid: the transaction id that was last read.
         # It is also possible to iterate over FileIterator, which yields
         # transactions in the form of a TransactionRecord
-        self.changed_oids = set()
-        if txn_start > txn_stop:
-            return
         storage = ZODB.FileStorage.FileIterator(
             self.datafs_path,
             start=txn_start,
             stop=txn_stop,
         )
-        for txn in storage:
-            # Each TransactionRecord has the following fields:
-            # * _pos: Position of the first data header
-            # * _tend: End of the last data block
-            # * _file: A reference to the file
-            pos = txn._pos
-            while pos < txn._tend:
-                dhead = storage._read_data_header(pos)
-                # each data header has the fields and methods
-                # * _recordlen(): gives the total length. Adding recordlen()
-                #   advances to the next data header
-                # * oid: the object ID
-                # * plen: the size of the pickle data, which comes after the
-                #   header
-                dlen = dhead.recordlen()
-                oid = self.additional_oids.get(bytes(dhead.oid),
-                                               bytes(dhead.oid))
-                self.changed_oids.add(oid)
-                pos = pos + dlen
-
-    def _update_path(self, oid, path):
+        unpack_from = DATA_HEADER.unpack_from
+        get_oid = self.additional_oids.get
+        known = self.parent_of
+        add_oid = self.changed_oids.add
+        try:
+            datafs = mmap.mmap(
+                storage._file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+            with datafs:
+                for txn in storage:
+                    # Each TransactionRecord has the following fields:
+                    # * _pos: Position of the first data header
+                    # * _tend: End of the last data block
+                    # * _file: A reference to the file
+                    pos = txn._pos
+                    tend = txn._tend
+                    while pos < tend:
+                        # Each data header is followed by the pickle data or,
+                        # if its size is zero, by an 8 byte backpointer.
+                        oid, plen = unpack_from(datafs, pos)
+                        oid = get_oid(oid, oid)
+                        if oid in known:
+                            add_oid(oid)
+                        pos += DATA_HDR_LEN + (plen or 8)
+        finally:
+            storage.close()
+
+    def _path(self, oid):
+        '''
+        Return the path of the object with the given oid as it is given by our
+        tree structure, following the parents up to the top-level object or
+        to an object that was orphaned. The paths of all objects on the way
+        are cached, so whenever an object has a cached path, so do all its
+        ancestors.
+        '''
+        cache = self._path_cache
+        path = cache.get(oid)
+        if path is not None:
+            return path
+        parent_of = self.parent_of
+        chain = []
+        while oid not in cache:
+            parent = parent_of[oid]
+            if parent is None:
+                if oid == self.root_oid:
+                    cache[oid] = '/'
+                else:
+                    cache[oid] = '/../__orphans__/%s/' % (
+                        binascii.hexlify(oid).decode('ascii')
+                    )
+                break
+            chain.append(oid)
+            oid = parent
+        path = cache[oid]
+        children_of = self.children_of
+        for child_oid in reversed(chain):
+            path = path + children_of[oid][child_oid] + '/'
+            cache[child_oid] = path
+            oid = child_oid
+        return path
+
+    def _update_path(self, oid):
+        '''
+        If an element has been moved, this is called to drop the cached paths
+        for the subtree. Since the ancestors of any object with a cached path
+        also have one, we do not need to descend below objects without one.
+        '''
+        cache = self._path_cache
+        children_of = self.children_of
+        stack = [oid]
+        while stack:
+            oid = stack.pop()
+            if cache.pop(oid, None) is not None:
+                stack.extend(children_of[oid])
+
+    def _prefetch(self, oids):
         '''
-        If an element has been moved, this is called to update the path for the
-        subtree
+        Let the storage load the objects with the given oids into its cache,
+        which for ZEO is done with a single request. Older versions of ZODB do
+        not support this.
         '''
-        node = self.object_tree[oid]
-        node['path'] = path
-        for child_oid, child_id in node['children'].items():
-            self._update_path(oid=child_oid, path=path+child_id+'/')
+        prefetch = getattr(self.app._p_jar, 'prefetch', None)
+        if prefetch is not None and oids:
+            prefetch(oids)
 
     def _record_object(self, oid):
         '''
-        Store data of an object at the path stored in our object tree.
+        Store data of an object at the path given by our object tree.
         '''
-        path = self.object_tree[oid]['path']
+        path = self._path(oid)
         self.logger.info('Recording %s' % path)
-        self.logger.debug('OID: ' + repr(oid))
+        self.logger.debug('OID: %r', oid)
 
         obj = self.app._p_jar[oid]
         data = mod_read(
@@ -192,6 +399,8 @@ class Watch(SubCommand):
             default_owner=self.sync.default_owner
         )
         self.sync.fs_write(path=path, data=data)
+        # Pick up objects that were added since we last looked, like new users
+        self._add_additional_oids(obj, oid)
 
     def _update_objects(self):
         '''
@@ -209,132 +418,147 @@ class Watch(SubCommand):
         if not len(self.changed_oids):
             return
         self.logger.info('Found %s changed objects' % len(self.changed_oids))
-        self.logger.debug('OIDs: ' + str(sorted(self.changed_oids)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Sorting and formatting all oids is expensive, only do it if the
+            # output is actually used
+            self.logger.debug('OIDs: ' + str(sorted(self.changed_oids)))
 
         self.adoption_list = set()
-        shutil.rmtree(self.base_dir+'/../__orphans__/', ignore_errors=True)
-
-        while len(self.changed_oids):
-            # not all oids are part of our object tree yet, so we have to
-            # iteratively update some at a time
-            next_oids = self.changed_oids.intersection(self.object_tree.keys())
-            if not len(next_oids):
-                # The remaining oids are not reachable by any of the currently
-                # existing nodes. This can happen during initialization, since
-                # the tree structure is created as visible at the end of the
-                # transaction chain and then affected objects are collected for
-                # earlier transactions, but they might no longer exist
-                break
-            for oid in next_oids:
-                self._record_object(oid=oid)
-                self._update_children(oid=oid)
-
-            self.changed_oids.difference_update(next_oids)
+        # Paths are only cached while processing one set of changes, during
+        # which we see a consistent snapshot of the ZODB
+        self._path_cache = {}
+        self._trash(self.orphans_dir)
+
+        parent_of = self.parent_of
+        children_of = self.children_of
+        adoption_list = self.adoption_list
+        record_object = self._record_object
+        update_children = self._update_children
+
+        # We start with the changed oids, which are all part of our object
+        # tree, and _update_children appends any new children it finds.
+        # Ask the storage to load all of them in one go instead of one round
+        # trip per object.
+        self._prefetch(self.changed_oids)
+        pending = collections.deque(self.changed_oids)
+        self.changed_oids = set()
+        while pending:
+            oid = pending.popleft()
+            record_object(oid=oid)
+            update_children(oid=oid, pending=pending)
 
         remove_paths = []
-        while len(self.adoption_list):
-            oid = self.adoption_list.pop()
-            node = self.object_tree[oid]
-            del self.object_tree[oid]
+        while len(adoption_list):
+            oid = adoption_list.pop()
+            if parent_of[oid] is None:
+                # An orphan that was not adopted. Objects below it are
+                # removed together with it.
+                remove_paths.append(self._path(oid))
+            del parent_of[oid]
 
             # recursively remove children from tree
-            self.adoption_list.update(node['children'])
-            parent_oid = node['parent']
-            if (parent_oid in self.object_tree
-                    and oid in self.object_tree[parent_oid]['children']):
-                del self.object_tree[parent_oid]['children'][oid]
-            remove_paths.append(node['path'])
+            adoption_list.update(children_of.pop(oid))
+
+        self._path_cache = {}
 
         remove_redundant_paths(remove_paths)
+        base_dir = self.base_dir
         for path in remove_paths:
             self.logger.info('Removing %s' % path)
-            shutil.rmtree(self.base_dir+path)
+            self._trash(base_dir+path)
 
-    def _update_children(self, oid):
+    def _update_children(self, oid, pending):
         '''
         Check the current children of an object and compare with the stored
         children. Rename children that changed their name, adopt new children
         that previously had different parents, create new children, and set
-        obsolete children up for adoption.
+        obsolete children up for adoption. New children are appended to
+        pending so they are recorded as well.
         '''
         obj = self.app._p_jar[oid]
-        node = self.object_tree[oid]
+        intern = sys.intern
+        parent_of = self.parent_of
+        children_of = self.children_of
+        adoption_list = self.adoption_list
+        base_dir = self.base_dir
+        get_path = self._path
+        update_path = self._update_path
+        logger = self.logger
+
+        children = children_of[oid]
+        if not children and not getattr(obj, 'isPrincipiaFolderish', False):
+            # Objects that are not folderish and had no children before can
+            # not have any now, no need to ask for them
+            return
 
         newchildren = {}
         for child_id, child_obj in obj.objectItems():
             if not hasattr(child_obj, '_p_oid'):
                 continue
-            newchildren[bytes(child_obj._p_oid)] = child_id
-
-        # go through old children and check if they are still there
-        for child_oid, child_id in list(node['children'].items()):
-            if (child_oid not in newchildren
-                    or child_id != newchildren[child_oid]):
-                # Put up for adoption. The new parent might show up later or it
-                # might be the same but the child was renamed.  However, we
-                # need to move the folder away immediately in case another
-                # object takes its place
-                self.adoption_list.add(child_oid)
-                del node['children'][child_oid]
-                self.object_tree[child_oid]['parent'] = None
-                oldpath = self.object_tree[child_oid]['path']
-                newpath = ('/../__orphans__/' +
-                           binascii.hexlify(child_oid).decode('ascii')
-                           )
-                self.logger.info(
-                    'Moving %s => %s' % (
-                        oldpath,
-                        newpath
-                    )
-                )
-                os.makedirs(self.base_dir+newpath)
-                try:
-                    os.rename(self.base_dir+oldpath, self.base_dir+newpath)
-                except OSError as err:
-                    if err.errno == 2:  # no such file or directory
-                        raise TreeOutdatedException()
-                    self.logger.exception('Unexpected OSError')
-                    raise
-                self._update_path(child_oid, newpath)
+            newchildren[bytes(child_obj._p_oid)] = intern(child_id)
 
-        # go through new children and check if they have old parents
-        for child_oid, child_id in list(newchildren.items()):
-            if child_oid in node['children']:
-                continue
-            newpath = node['path']+child_id+'/'
+        if newchildren == children:
+            # Usually, the object itself changed but not its children
+            return
+
+        node_path = get_path(oid)
+        node_dir = base_dir + node_path
+        old_oids = children.keys()
+        new_oids = newchildren.keys()
+        obsolete = old_oids - new_oids
+        obsolete.update(
+            child_oid for child_oid in old_oids & new_oids
+            if children[child_oid] != newchildren[child_oid]
+        )
 
-            if child_oid in self.object_tree:
+        # go through old children that are gone or were renamed
+        for child_oid in obsolete:
+            # Put up for adoption. The new parent might show up later or it
+            # might be the same but the child was renamed.  However, we
+            # need to move the folder away immediately in case another
+            # object takes its place
+            adoption_list.add(child_oid)
+            oldpath = get_path(child_oid)
+            del children[child_oid]
+            parent_of[child_oid] = None
+            update_path(child_oid)
+            newpath = get_path(child_oid)
+            logger.info('Moving %s => %s' % (oldpath, newpath))
+            target = base_dir + newpath
+            os.makedirs(target)
+            try:
+                os.rename(base_dir + oldpath, target)
+            except OSError as err:
+                if err.errno == 2:  # no such file or directory
+                    raise TreeOutdatedException()
+                logger.exception('Unexpected OSError')
+                raise
+
+        added = new_oids - children.keys()
+        self._prefetch(added - parent_of.keys())
+
+        # go through new children and check if they have old parents
+        for child_oid in added:
+            child_id = newchildren[child_oid]
+            if child_oid in parent_of:
                 # the parent changed
-                child = self.object_tree[child_oid]
-                self.logger.info(
-                    'Moving %s => %s' % (
-                        child['path'],
-                        newpath,
-                    )
-                )
-                os.rename(
-                    self.base_dir+child['path'],
-                    self.base_dir+newpath
-                )
-                if (child['parent'] is not None
-                        and child['parent'] in self.object_tree):
-                    children = self.object_tree[child['parent']]['children']
-                    del children[child_oid]
-                child['parent'] = oid
-                self._update_path(child_oid, node['path']+child_id+'/')
-                if child_oid in self.adoption_list:
-                    self.adoption_list.remove(child_oid)
+                oldpath = get_path(child_oid)
+                logger.info('Moving %s => %s' % (
+                    oldpath, node_path + child_id + '/'
+                ))
+                os.rename(base_dir + oldpath, node_dir + child_id)
+                old_parent = parent_of[child_oid]
+                if old_parent is not None:
+                    del children_of[old_parent][child_oid]
+                adoption_list.discard(child_oid)
             else:
-                # A new child not yet known in our tree. Usually, it will
-                # already be in changed_oids and the following is a no-op -
-                # except if an object hierarchy was resurrected by an Undo.
-                self.changed_oids.add(child_oid)
-                self.object_tree[child_oid] = {
-                    'parent': oid,
-                    'children': {},
-                    'path': newpath,
-                }
-            node['children'][child_oid] = child_id
+                # A new child not yet known in our tree, which needs to be
+                # recorded.
+                pending.append(child_oid)
+                children_of[child_oid] = {}
+            parent_of[child_oid] = oid
+            children[child_oid] = child_id
+            update_path(child_oid)
 
     def quit(self, signo, _frame):
         """
@@ -342,7 +566,7 @@ class Watch(SubCommand):
         """
         self.logger.info('Caught signal, exiting...')
         self.unregister_signals()
-        self.exit.set()
+        self.exiting = True
 
     def register_signals(self):
         for sig in ('TERM', 'HUP', 'INT'):
@@ -362,13 +586,13 @@ class Watch(SubCommand):
         self.last_report = None
 
         # During normal operation, we always assume that the hard disk tree
-        # structure is mirrored in object_tree, which mirrors the ZODB after
-        # transaction A. When reading data in our Zope instance, we see the
-        # ZODB after some later transaction B. We obtain the list of changed
-        # object ids between A and B. Then we look up all objects that we know
-        # of which were changed, record their meta data and move children
-        # around, until our tree as well as the file system mirrors the state
-        # at B (and our list of changed objects is empty).
+        # structure is mirrored in our object tree, which mirrors the ZODB
+        # after transaction A. When reading data in our Zope instance, we see
+        # the ZODB after some later transaction B. We obtain the list of
+        # changed object ids between A and B. Then we look up all objects that
+        # we know of which were changed, record their meta data and move
+        # children around, until our tree as well as the file system mirrors
+        # the state at B (and our list of changed objects is empty).
         #
         # However, at startup the situation is different. Our object tree is
         # the same that we see through our Zope instance, which is the state
@@ -377,22 +601,71 @@ class Watch(SubCommand):
         # the file system (which would also require to store the OIDs), we do
         # not know which move operations would take us from A to B. Instead, we
         # collect a list of all changed paths and record them recursively.
+        #
+        # The exception is if we stored our object tree when stopping after A.
+        # Then we can load it and proceed as during normal operation.
 
         self.acquire_lock(timeout=300)
+        # Remove anything left in the trash by a previous run
+        shutil.rmtree(self.trash_dir, ignore_errors=True)
         self._set_last_visible_txn()
         self.sync.tm.begin()
-        self._init_tree(self.app)
 
         # the transaction ID stored on disk is the last transaction whose
         # changes have already been recorded to disk. We increase it by one to
         # obtain all changes after that one
         self.txnid_on_disk = self.sync.txn_read()
+        if self.txnid_on_disk is not None:
+            self.txnid_on_disk = base64.b64decode(self.txnid_on_disk)
+
+        if not self._setup_from_stored_tree():
+            self._setup_from_scratch()
+
+        self.sync.tm.abort()
+
+        # store an updated txnid on disk
+        self._store_last_visible_txn()
+        self._store_tree()
+
+        self.release_lock()
+
+        self.logger.info("Setup complete")
+
+    def _setup_from_stored_tree(self):
+        """
+        Load the object tree stored by a previous run and apply all changes
+        since then. Returns False if this is not possible.
+        """
+        if not self._load_tree():
+            return False
+        self._read_changed_oids(
+            txn_start=increment_txnid(self.txnid_on_disk),
+            txn_stop=self.last_visible_txn,
+        )
+        try:
+            self._update_objects()
+        except TreeOutdatedException:
+            self.logger.warning(
+                'Stored object tree does not match the file system'
+            )
+            self.parent_of = {}
+            self.children_of = {}
+            self.additional_oids = {}
+            self._path_cache = {}
+            return False
+        return True
+
+    def _setup_from_scratch(self):
+        """
+        Build the object tree from the ZODB and record all paths that changed
+        since the transaction ID stored on disk.
+        """
+        self._init_tree(self.app)
 
         if self.txnid_on_disk is None:
             # no txnid found, record everything
             paths = ['/']
         else:
-            self.txnid_on_disk = base64.b64decode(self.txnid_on_disk)
             txn_start = increment_txnid(self.txnid_on_disk)
 
             # obtain all object ids affected by transactions between (the one
@@ -401,37 +674,90 @@ class Watch(SubCommand):
                 txn_start=txn_start,
                 txn_stop=self.last_visible_txn
             )
-            paths = []
-            while len(self.changed_oids):
-                next_oids = self.changed_oids.intersection(
-                    self.object_tree.keys()
-                )
-                if not len(next_oids):
-                    # The remaining oids are not reachable by any of the
-                    # currently existing nodes. This can happen during
-                    # initialization since the tree structure is created as
-                    # visible at the end of the transaction chain and then
-                    # affected objects are collected for earlier transactions,
-                    # but they might no longer exist
-                    break
-                paths.extend(
-                    [self.object_tree[oid]['path'] for oid in next_oids]
-                )
-                self.changed_oids.difference_update(next_oids)
+            # Only the oids found in our tree are collected. The others are
+            # not reachable by any of the currently existing nodes. This can
+            # happen since the tree structure is created as visible at the end
+            # of the transaction chain and then affected objects are collected
+            # for earlier transactions, but they might no longer exist
+            paths = [self._path(oid) for oid in self.changed_oids]
 
         remove_redundant_paths(paths)
         for path in paths:
             self.logger.info('Recording %s' % path)
             self.sync.record(path)
 
-        self.sync.tm.abort()
-
-        # store an updated txnid on disk
-        self._store_last_visible_txn()
-
-        self.release_lock()
-
-        self.logger.info("Setup complete")
+    def _store_tree(self):
+        """
+        Store the object tree together with the transaction ID it mirrors, so
+        the next run can skip building it if nothing else changed the
+        transaction ID on disk in the meantime.
+        """
+        if not self.tree_path or self.txnid_on_disk is None:
+            return
+        data = {
+            'parent_of': self.parent_of,
+            'children_of': self.children_of,
+            'add_oids': self.additional_oids,
+            'txn': self.txnid_on_disk,
+        }
+        tmp_path = self.tree_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.tree_path)
+        except OSError as err:
+            # The stored tree is only an optimization, so we do without it
+            self.logger.warning('Unable to store object tree: %s' % err)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _load_tree(self):
+        """
+        Load the object tree stored by _store_tree if it mirrors the
+        transaction ID on disk and a few of its objects can still be found
+        in the ZODB. Returns True if successful.
+        """
+        if not self.tree_path or self.txnid_on_disk is None:
+            return False
+        try:
+            with open(self.tree_path, 'rb') as f:
+                data = pickle.load(f)
+            txn = data['txn']
+            parent_of = data['parent_of']
+            children_of = data['children_of']
+            additional_oids = data['add_oids']
+            for value in (parent_of, children_of, additional_oids):
+                if not isinstance(value, dict):
+                    raise TypeError('Expected dict, got {}'.format(
+                        type(value).__name__
+                    ))
+        except FileNotFoundError:
+            return False
+        except Exception:
+            self.logger.exception('Unable to read stored object tree')
+            return False
+
+        if txn != self.txnid_on_disk:
+            self.logger.info('Stored object tree is outdated')
+            return False
+        if self.root_oid not in parent_of:
+            self.logger.info('Stored object tree belongs to another ZODB')
+            return False
+        jar = self.app._p_jar
+        for oid in itertools.islice(parent_of, 10):
+            try:
+                jar[oid]._p_activate()
+            except KeyError:
+                self.logger.info('Stored object tree does not match ZODB')
+                return False
+
+        self.logger.info('Using stored object tree')
+        self.parent_of = parent_of
+        self.children_of = children_of
+        self.additional_oids = additional_oids
+        return True
 
     def spawned_setup(self):
         """
@@ -444,7 +770,8 @@ class Watch(SubCommand):
         cmd = [sys.executable, sys.argv[0], '--config', self.args.config,
                'watch', '--init']
         data = pickle.loads(subprocess.check_output(cmd))
-        self.object_tree = data['tree']
+        self.parent_of = data['parent_of']
+        self.children_of = data['children_of']
         self.additional_oids = data['add_oids']
         self.last_visible_txn = self.txnid_on_disk = data['txn']
 
@@ -453,7 +780,8 @@ class Watch(SubCommand):
         Print pickled setup data for usage in main process.
         """
         data = {
-            'tree': self.object_tree,
+            'parent_of': self.parent_of,
+            'children_of': self.children_of,
             'add_oids': self.additional_oids,
             'txn': self.last_visible_txn,
         }
@@ -486,7 +814,7 @@ class Watch(SubCommand):
             self.logger.info(
                 'Exiting due to inconsistencies in filesystem'
             )
-            self.exit.set()
+            self.exiting = True
         finally:
             self.release_lock()
 
@@ -495,10 +823,47 @@ class Watch(SubCommand):
         if self.args.init:
             self.setup()
             self.dump_setup_data()
+            # Do not leave anything in the trash when this process ends
+            self._stop_trash(timeout=None)
             return
         else:
             self.spawned_setup()
-        while not self.exit.is_set():
-            self.step()
-            # a wait that is interrupted immediately if exit.set() is called
-            self.exit.wait(interval)
+
+        # Any signal that is caught writes a byte into this pipe, which
+        # interrupts the wait between two steps immediately
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        old_wakeup_fd = signal.set_wakeup_fd(wakeup_w)
+        selector = selectors.DefaultSelector()
+        selector.register(wakeup_r, selectors.EVENT_READ)
+        try:
+            while not self.exiting:
+                self.step()
+                # The step itself might have decided that we need to exit
+                if self.exiting:
+                    break
+                if selector.select(interval):
+                    self._drain(wakeup_r)
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            selector.close()
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+            self._stop_trash()
+
+        # If the last step failed, our tree does not mirror the file system
+        if self.last_visible_txn == self.txnid_on_disk:
+            self._store_tree()
+
+    @staticmethod
+    def _drain(fd):
+        """
+        Read everything currently available from a non-blocking file
+        descriptor.
+        """
+        try:
+            while os.read(fd, 512):
+                pass
+        except BlockingIOError:
+            pass
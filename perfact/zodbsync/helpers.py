@@ -40,16 +40,19 @@ def remove_redundant_paths(paths):
     paths are processed recursively, i.e., if /a/b/ as well as /a/ are
     included, remove /a/b/. Works in-place and also returns the list.
     '''
-    paths.sort()
-    i = 0
+    # Sorting by the normalized path makes sure each path is directly
+    # followed by its subpaths, so a single comparison with the last kept
+    # path is enough.
+    paths.sort(key=lambda path: path.rstrip('/') + '/')
+    result = []
     last = None
-    while i < len(paths):
-        current = paths[i].rstrip('/') + '/'
+    for path in paths:
+        current = path.rstrip('/') + '/'
         if last is not None and current.startswith(last):
-            del paths[i]
             continue
+        result.append(path)
         last = current
-        i += 1
+    paths[:] = result
     return paths
 
 
@@ -223,13 +226,6 @@ def load_config(filename, name='config'):
 # Helper for handling transaction IDs (which are byte strings of length 8)
 def increment_txnid(s):
     ''' add 1 to s, but for s being a string of bytes'''
-    arr = bytearray(s)
-    pos = len(arr)-1
-    while pos >= 0:
-        if arr[pos] == 255:
-            arr[pos] = 0
-            pos -= 1
-        else:
-            arr[pos] += 1
-            break
-    return bytes(arr)
+    width = len(s)
+    num = (int.from_bytes(s, 'big') + 1) % (1 << (8 * width))
+    return num.to_bytes(width, 'big')
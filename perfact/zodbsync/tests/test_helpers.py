@@ -32,6 +32,16 @@ def test_remove_redundant_paths_only_real_subpaths():
     assert paths == new_paths
 
 
+def test_remove_redundant_paths_sibling_prefix():
+    """
+    Check that subpaths are removed even if a sibling whose name starts with
+    the same characters is sorted in between.
+    """
+    paths = ['/a/b/', '/a-b/', '/a/']
+    helpers.remove_redundant_paths(paths)
+    assert paths == ['/a-b/', '/a/']
+
+
 def test_converters():
     """
     Several tests for to_* methods
@@ -123,3 +133,12 @@ def test_literal_eval():
     assert helpers.literal_eval("-True") == -1
     with pytest.raises(Exception):
         helpers.literal_eval('f(1)')
+
+
+def test_increment_txnid():
+    """
+    Check that transaction IDs are incremented with carry and wrap around
+    """
+    assert helpers.increment_txnid(b'\x00' * 8) == b'\x00' * 7 + b'\x01'
+    assert helpers.increment_txnid(b'\x01\xff') == b'\x02\x00'
+    assert helpers.increment_txnid(b'\xff' * 8) == b'\x00' * 8
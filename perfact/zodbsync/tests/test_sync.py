@@ -8,6 +8,8 @@ import subprocess
 import pickle
 import pytest
 import shutil
+import signal
+import threading
 
 import ZEO
 import transaction
@@ -28,6 +30,7 @@ from .. import zodbsync
 from .. import helpers
 from .. import extedit
 from .. import object_types
+from ..commands.watch import TreeOutdatedException
 from . import environment as env
 
 
@@ -641,6 +644,20 @@ class TestSync():
         self.watcher_step_until(watcher,
                                 lambda: 'TestRole' in open(fname).read())
 
+    def test_watch_change_without_datafs(self, conn):
+        """
+        Make sure the watcher also notices changes if it can not access the
+        Data.FS directly and needs to use the iterator of the storage.
+        """
+        fname = self.repo.path + '/__root__/__meta__'
+        watcher = self.mkrunner('watch')
+        watcher.datafs_path = None
+        watcher.setup()
+        with conn.tm:
+            conn.app._addRole('OtherRole')
+        self.watcher_step_until(watcher,
+                                lambda: 'OtherRole' in open(fname).read())
+
     def test_watch_move(self, conn):
         """
         Create a Page Template, record it using the watcher, rename it and make
@@ -693,6 +710,243 @@ class TestSync():
         assert open(root + 'test1' + src).read() == 'test1'
         assert open(root + 'test2' + src).read() == 'test2'
 
+    def test_watch_move_subtree(self, conn):
+        """
+        Create a folder containing a subfolder with a Page Template, record it
+        using the watcher, rename the folder and make sure the watcher keeps
+        track of the contained objects, which are then changed. Finally,
+        remove the folder.
+        """
+        watcher = self.mkrunner('watch')
+        watcher.setup()
+        root = self.repo.path + '/__root__/'
+        src = '/__source-utf8__.html'
+        app = conn.app
+
+        with conn.tm:
+            app.manage_addFolder(id='outer')
+            app.outer.manage_addFolder(id='inner')
+            app.outer.inner.manage_addProduct[
+                'PageTemplates'
+            ].manage_addPageTemplate(id='page', text='test1')
+        self.watcher_step_until(
+            watcher,
+            lambda: os.path.isdir(root + 'outer/inner/page'),
+        )
+
+        userfolder = conn.app.acl_users
+        user = userfolder.getUser('perfact').__of__(userfolder)
+        newSecurityManager(None, user)
+
+        with conn.tm:
+            app.manage_renameObject('outer', 'moved')
+        self.watcher_step_until(
+            watcher,
+            lambda: os.path.isdir(root + 'moved/inner/page'),
+        )
+        assert not os.path.isdir(root + 'outer')
+
+        with conn.tm:
+            app.moved.inner.page.write('test2')
+        self.watcher_step_until(
+            watcher,
+            lambda: open(root + 'moved/inner/page' + src).read() == 'test2',
+        )
+
+        with conn.tm:
+            app.manage_delObjects(ids=['moved'])
+        self.watcher_step_until(
+            watcher,
+            lambda: not os.path.isdir(root + 'moved'),
+        )
+
+    def test_watch_trash_outside_worktree(self, conn):
+        """
+        Remove a folder with contents while the trash is not emptied and make
+        sure that what is left in the trash can not be picked up by git.
+        """
+        watcher = self.mkrunner('watch')
+        watcher.setup()
+        root = self.repo.path + '/__root__/'
+        app = conn.app
+
+        with conn.tm:
+            app.manage_addFolder(id='doomed')
+            app.doomed.manage_addFolder(id='inner')
+        self.watcher_step_until(
+            watcher,
+            lambda: os.path.isdir(root + 'doomed/inner'),
+        )
+
+        with mock.patch.object(watcher, '_empty_trash'):
+            with conn.tm:
+                app.manage_delObjects(ids=['doomed'])
+            self.watcher_step_until(
+                watcher,
+                lambda: not os.path.isdir(root + 'doomed'),
+            )
+            watcher._stop_trash()
+
+        assert os.listdir(watcher.trash_dir)
+        git_dir = os.path.realpath(self.repo.path + '/.git') + '/'
+        assert os.path.realpath(watcher.trash_dir).startswith(git_dir)
+        status = self.gitoutput(
+            'status', '--porcelain', '--untracked-files=all',
+        )
+        assert 'doomed' not in status
+        assert 'trash' not in status
+        shutil.rmtree(watcher.trash_dir)
+
+    def test_watch_stored_tree(self, conn, tmp_path):
+        """
+        Let a watcher store its object tree, change something while no
+        watcher is running and make sure the next watcher records the change
+        using the stored tree instead of building its own.
+        """
+        tree_path = str(tmp_path / 'watch_tree')
+        watcher = self.mkrunner('watch')
+        watcher.tree_path = tree_path
+        watcher.setup()
+        assert os.path.isfile(tree_path)
+
+        root = self.repo.path + '/__root__/'
+        with conn.tm:
+            conn.app.manage_addFolder(id='stored_tree')
+
+        watcher = self.mkrunner('watch')
+        watcher.tree_path = tree_path
+        with mock.patch.object(watcher, '_init_tree') as init_tree:
+            watcher.setup()
+            self.watcher_step_until(
+                watcher,
+                lambda: os.path.isdir(root + 'stored_tree'),
+            )
+        assert not init_tree.called
+
+    def test_watch_stored_tree_unwritable(self, tmp_path):
+        """
+        Make sure that a watcher whose object tree can not be stored still
+        starts up and leaves no temporary file behind.
+        """
+        tree_path = str(tmp_path / 'watch_tree')
+        watcher = self.mkrunner('watch')
+        watcher.tree_path = tree_path
+        with mock.patch('os.replace', side_effect=OSError('disk full')):
+            watcher.setup()
+        assert os.listdir(str(tmp_path)) == []
+
+        watcher.tree_path = str(tmp_path / 'missing' / 'watch_tree')
+        watcher._store_tree()
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_watch_stored_tree_new_user(self, conn, tmp_path):
+        """
+        Add a user while a watcher is running, change it while no watcher is
+        running and make sure the next watcher using the stored tree still
+        records the change.
+        """
+        tree_path = str(tmp_path / 'watch_tree')
+        watcher = self.mkrunner('watch')
+        watcher.tree_path = tree_path
+        watcher.setup()
+
+        meta = self.repo.path + '/__root__/acl_users/__meta__'
+        with conn.tm:
+            conn.app.acl_users._doAddUser('newguy', 'pw', ['Manager'], [])
+        self.watcher_step_until(
+            watcher,
+            lambda: 'newguy' in open(meta).read(),
+        )
+        watcher._store_tree()
+
+        with conn.tm:
+            conn.app.acl_users._doChangeUser('newguy', 'pw', ['Owner'], [])
+
+        watcher = self.mkrunner('watch')
+        watcher.tree_path = tree_path
+        with mock.patch.object(watcher, '_init_tree') as init_tree:
+            watcher.setup()
+        assert not init_tree.called
+        assert 'Owner' in open(meta).read()
+
+    @pytest.mark.parametrize('content', [
+        ['not', 'a', 'tree'],
+        {'txn': None},
+        {'txn': None, 'parent_of': [], 'children_of': {}, 'add_oids': {}},
+    ])
+    def test_watch_stored_tree_malformed(self, tmp_path, content):
+        """
+        Provide a stored object tree that does not have the expected structure
+        and make sure the watcher falls back to building its own tree.
+        """
+        tree_path = str(tmp_path / 'watch_tree')
+        watcher = self.mkrunner('watch')
+        watcher.setup()
+        with open(tree_path, 'wb') as f:
+            pickle.dump(content, f)
+
+        watcher = self.mkrunner('watch')
+        watcher.tree_path = tree_path
+        with mock.patch.object(
+            watcher, '_init_tree', wraps=watcher._init_tree,
+        ) as init_tree:
+            watcher.setup()
+        assert init_tree.called
+
+    def run_watcher_until_exit(self, watcher):
+        """
+        Run the watcher loop with a long interval, making sure that it returns
+        promptly and restores the previous wakeup file descriptor.
+        """
+        watcher.spawned_setup = watcher.setup
+        old_wakeup_fd = signal.set_wakeup_fd(-1)
+        signal.set_wakeup_fd(old_wakeup_fd)
+        start = time.time()
+        watcher.run(interval=60)
+        assert time.time() - start < 10
+        assert signal.set_wakeup_fd(old_wakeup_fd) == old_wakeup_fd
+
+    def test_watch_run_signal(self):
+        """
+        Send a signal to a running watcher and check that it exits without
+        waiting for the interval to pass.
+        """
+        watcher = self.mkrunner('watch')
+        timer = threading.Timer(
+            0.5, os.kill, args=(os.getpid(), signal.SIGTERM),
+        )
+        step = watcher.step
+
+        def step_and_signal():
+            # Only send the signal once our handler is installed and the loop
+            # is about to wait for the next step
+            step()
+            if timer.ident is None:
+                assert signal.getsignal(signal.SIGTERM) == watcher.quit
+                timer.start()
+
+        watcher.step = step_and_signal
+        try:
+            self.run_watcher_until_exit(watcher)
+        finally:
+            timer.cancel()
+            watcher.unregister_signals()
+        assert watcher.exiting
+
+    def test_watch_run_outdated(self):
+        """
+        Let a step find that the file system is outdated and check that the
+        watcher exits without waiting for the interval to pass.
+        """
+        watcher = self.mkrunner('watch')
+        watcher.setup()
+        with mock.patch.object(
+            watcher, '_update_objects', side_effect=TreeOutdatedException,
+        ):
+            watcher.setup = mock.Mock()
+            self.run_watcher_until_exit(watcher)
+        watcher.unregister_signals()
+
     def test_watch_dump_setup(self):
         """
         Check output that a spawned initialization subprocess would generate.
@@ -702,12 +956,15 @@ class TestSync():
         stream = io.BytesIO()
         watcher.dump_setup_data(stream=stream)
         data = pickle.loads(stream.getvalue())
-        assert set(data.keys()) == {'tree', 'txn', 'add_oids'}
-        tofind = ['/', '/acl_users/', '/index_html/']
-        for obj in data['tree'].values():
-            if obj['path'] in tofind:
-                tofind.remove(obj['path'])
-        assert tofind == []
+        assert set(data.keys()) == {
+            'parent_of', 'children_of', 'txn', 'add_oids',
+        }
+        root_oid = bytes(self.app._p_oid)
+        assert data['parent_of'][root_oid] is None
+        children = data['children_of'][root_oid]
+        assert {'acl_users', 'index_html'} <= set(children.values())
+        for child_oid in children:
+            assert data['parent_of'][child_oid] == root_oid
 
     def test_reset(self):
         """
@@ -988,7 +1245,7 @@ class TestSync():
         self.run('playback', '/')
 
         # wait for watch to notices played back changes
-        self.watcher_step_until(watcher, watcher.exit.is_set)
+        self.watcher_step_until(watcher, lambda: watcher.exiting)
 
     def test_commit_on_branch_and_exec_merge(self):
         '''